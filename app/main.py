@@ -2,27 +2,31 @@ import sys
 import asyncio
 
 import threading
-LOCK = threading.Lock()
 
 # Necessário no Windows para libs que usam subprocess/asyncio em alguns cenários
 if sys.platform.startswith("win"):
     asyncio.set_event_loop_policy(asyncio.WindowsProactorEventLoopPolicy())
 
+import os
+import time
 import uuid
-import json
+import orjson
+import tempfile
 import traceback
+from collections import OrderedDict
 from datetime import datetime
 import pandas as pd
 
 from fastapi import FastAPI, UploadFile, File, HTTPException, Query
-from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
+from fastapi.responses import FileResponse, HTMLResponse, JSONResponse
 from fastapi.staticfiles import StaticFiles
 from starlette.requests import Request
 from sse_starlette.sse import EventSourceResponse
 from starlette.templating import Jinja2Templates
 
 from app.services.io_files import read_input_file_to_df, build_output_bytes
-from app.services.consulta_optantes import consultar_optante_lote
+from app.services.consulta_optantes import consultar_optante_lote_async
+from app.services.consulta_site import close_client
 
 
 app = FastAPI()
@@ -30,8 +34,108 @@ app = FastAPI()
 app.mount("/static", StaticFiles(directory="app/static"), name="static")
 templates = Jinja2Templates(directory="app/templates")
 
+# Arquivo de resultado fica em disco (não em RAM) e é apagado depois desse tempo
+JOB_TTL_SECONDS = int(os.getenv("JOB_TTL_SECONDS", str(60 * 60)))
+
+# Limite de jobs guardados em memória e intervalo da limpeza periódica
+MAX_JOBS = int(os.getenv("MAX_JOBS", "256"))
+JOB_GC_INTERVAL_SECONDS = 300
+
+
+class JobStore(OrderedDict):
+    """Dict de jobs com limite: passando de ``max_jobs``, descarta os concluídos mais antigos.
+
+    Jobs em andamento nunca são descartados.
+    """
+
+    def __init__(self, max_jobs: int):
+        super().__init__()
+        self.max_jobs = max_jobs
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        excess = len(self) - self.max_jobs
+        if excess > 0:
+            for job_id in [k for k, j in self.items() if j.get("done")][:excess]:
+                _remove_file(self.pop(job_id).get("file_path"))
+
+
 # Jobs em memória
-JOBS = {}  # job_id -> dict(status, progress, total, done, file_bytes, file_name, error, cancel_event)
+# Campos escalares (progress/total/status) são escritos sem lock (atribuição em dict é
+# atômica no CPython); o "lock" do job protege só as transições compostas (conclusão/cancelamento).
+JOBS = JobStore(MAX_JOBS)  # job_id -> dict(status, progress, total, done, file_path, file_name, error, cancel_event, lock, event, loop, created_at, finished_at)
+
+_gc_task = None
+
+
+def _write_temp_file(file_bytes: bytes, output: str) -> str:
+    fd, path = tempfile.mkstemp(prefix="consulta-optantes-", suffix=f".{output}")
+    with os.fdopen(fd, "wb") as f:
+        f.write(file_bytes)
+    return path
+
+
+def _remove_file(path: str | None) -> None:
+    if not path:
+        return
+    try:
+        os.unlink(path)
+    except OSError:
+        # já removido, ou (no Windows) ainda aberto por um download em andamento
+        pass
+
+
+async def _ttl_cleanup(job_id: str, ttl_seconds: int) -> None:
+    """Apaga o arquivo e remove o job depois do TTL."""
+    await asyncio.sleep(ttl_seconds)
+    job = JOBS.pop(job_id, None)
+    if job:
+        _remove_file(job.get("file_path"))
+
+
+def _wake(job: dict) -> None:
+    # Troca o Event antes de disparar: cada cliente SSE espera no Event que pegou
+    # antes de ler o estado, então nenhum perde transição (sem clear() compartilhado).
+    ev = job["event"]
+    job["event"] = asyncio.Event()
+    ev.set()
+
+
+def _notify(job: dict) -> None:
+    """Acorda os streams SSE do job (seguro para chamar de qualquer thread)."""
+    job["loop"].call_soon_threadsafe(_wake, job)
+
+
+def _prune_jobs(max_age_seconds: int) -> None:
+    """Remove jobs concluídos há mais de ``max_age_seconds`` (e seus arquivos)."""
+    cutoff = time.time() - max_age_seconds
+    for job_id in [k for k, j in JOBS.items() if j.get("finished_at") and j["finished_at"] < cutoff]:
+        job = JOBS.pop(job_id, None)
+        if job:
+            _remove_file(job.get("file_path"))
+
+
+async def _gc_loop() -> None:
+    while True:
+        await asyncio.sleep(JOB_GC_INTERVAL_SECONDS)
+        _prune_jobs(JOB_TTL_SECONDS)
+
+
+@app.on_event("startup")
+async def startup():
+    global _gc_task
+    _gc_task = asyncio.create_task(_gc_loop())
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    if _gc_task:
+        _gc_task.cancel()
+    # JOBS só existe em memória: sem isso os arquivos temporários ficariam órfãos
+    for job in list(JOBS.values()):
+        _remove_file(job.get("file_path"))
+    await close_client()
 
 
 @app.get("/", response_class=HTMLResponse)
@@ -81,10 +185,15 @@ async def criar_lote(
         "progress": 0,
         "total": len(cnpjs) + total_invalidos,  # ✅ total real (válidos + inválidos)
         "done": False,
-        "file_bytes": None,
+        "file_path": None,
         "file_name": f"resultado.{output}",
         "error": None,
         "cancel_event": threading.Event(),
+        "lock": threading.Lock(),
+        "event": asyncio.Event(),
+        "loop": asyncio.get_running_loop(),
+        "created_at": time.time(),
+        "finished_at": None,
     }
 
     asyncio.create_task(processar_job(job_id, df, output, sleep_seconds))
@@ -92,44 +201,53 @@ async def criar_lote(
 
 
 async def processar_job(job_id: str, df_validos, output: str, sleep_seconds: float):
+    job = JOBS[job_id]
     try:
-        with LOCK:
-            JOBS[job_id]["status"] = "running"
+        job["status"] = "running"
+        _notify(job)
 
         def progress_cb(done: int, total: int):
-            with LOCK:
-                # total pode ser reafirmado (válidos + inválidos)
-                JOBS[job_id]["total"] = total
-                JOBS[job_id]["progress"] = done
-
-        def _run():
-            return consultar_optante_lote(
-                df_validos,
-                sleep_seconds=sleep_seconds,
-                progress_cb=progress_cb,
-                should_cancel=lambda: bool(JOBS.get(job_id, {}).get("cancel_event") and JOBS[job_id]["cancel_event"].is_set()),
-            )
-
-        df_out = await asyncio.to_thread(_run)
-
-        file_bytes = build_output_bytes(df_out, output)
-        with LOCK:
-            JOBS[job_id]["file_bytes"] = file_bytes
-            JOBS[job_id]["done"] = True
+            # total pode ser reafirmado (válidos + inválidos)
+            job["total"] = total
+            job["progress"] = done
+            _notify(job)
+
+        # Roda direto no event loop: o lote é I/O-bound e o rate limit é assíncrono
+        df_out = await consultar_optante_lote_async(
+            df_validos,
+            sleep_seconds=sleep_seconds,
+            progress_cb=progress_cb,
+            should_cancel=job["cancel_event"].is_set,
+        )
+
+        # Geração do arquivo é CPU-bound: tira do event loop
+        file_bytes = await asyncio.to_thread(build_output_bytes, df_out, output)
+        file_path = await asyncio.to_thread(_write_temp_file, file_bytes, output)
+        del file_bytes
+        with job["lock"]:
+            job["file_path"] = file_path
+            job["finished_at"] = time.time()
+            job["done"] = True
 
             # Se cancelou, marcamos status "canceled", mas ainda liberamos download do parcial
-            if JOBS[job_id]["cancel_event"].is_set():
-                JOBS[job_id]["status"] = "canceled"
+            if job["cancel_event"].is_set():
+                job["status"] = "canceled"
             else:
-                JOBS[job_id]["status"] = "done"
-                JOBS[job_id]["progress"] = JOBS[job_id]["total"]
+                job["status"] = "done"
+                job["progress"] = job["total"]
+        _notify(job)
 
     except Exception as e:
         traceback.print_exc()
-        with LOCK:
-            JOBS[job_id]["status"] = "error"
-            JOBS[job_id]["error"] = f"{type(e).__name__}: {e}"
-            JOBS[job_id]["done"] = True
+        with job["lock"]:
+            job["status"] = "error"
+            job["error"] = f"{type(e).__name__}: {e}"
+            job["finished_at"] = time.time()
+            job["done"] = True
+        _notify(job)
+
+    finally:
+        asyncio.create_task(_ttl_cleanup(job_id, JOB_TTL_SECONDS))
 
 @app.get("/status/{job_id}")
 async def status(job_id: str):
@@ -143,7 +261,7 @@ async def status(job_id: str):
             "total": job["total"],
             "done": job["done"],
             "error": job["error"],
-            "has_file": job["file_bytes"] is not None,
+            "has_file": job["file_path"] is not None,
             "canceled": bool(job.get("cancel_event") and job["cancel_event"].is_set()),
         }
     )
@@ -162,10 +280,11 @@ async def cancelar(job_id: str):
     ev = job.get("cancel_event")
     if ev:
         ev.set()
-    with LOCK:
+    with job["lock"]:
         # não marca done aqui: o worker vai finalizar e gerar o arquivo parcial
         if job.get("status") in {"queued", "running"}:
             job["status"] = "canceling"
+    _notify(job)
     return JSONResponse({"ok": True, "status": "canceling"})
 
 
@@ -175,8 +294,7 @@ async def progresso(job_id: str):
         raise HTTPException(404, "job não encontrado")
 
     async def event_generator():
-        last = -1
-        last_ping = asyncio.get_event_loop().time()
+        last = None
 
         # Sinaliza ao client para tentar reconectar rapidamente caso a conexão caia
         yield {"event": "open", "data": "ok", "retry": 5000}
@@ -185,31 +303,33 @@ async def progresso(job_id: str):
             if not job:
                 break
 
+            # pega o Event ANTES de ler o estado: qualquer mudança depois disso o dispara
+            changed = job["event"]
+
             if job["status"] == "error":
                 yield {"event": "error", "data": job["error"] or "Erro desconhecido"}
                 break
 
-            if job["progress"] != last:
-                last = job["progress"]
-                payload = {
-                    "status": job["status"],
-                    "progress": job["progress"],
-                    "total": job["total"],
-                    "done": job["done"],
-                }
-                yield {"event": "progress", "data": json.dumps(payload, ensure_ascii=False)}
-
-            # Keep-alive (alguns proxies derrubam SSE em streams "silenciosos")
-            now = asyncio.get_event_loop().time()
-            if now - last_ping >= 15:
-                last_ping = now
-                yield {"event": "ping", "data": "keepalive"}
+            payload = {
+                "status": job["status"],
+                "progress": job["progress"],
+                "total": job["total"],
+                "done": job["done"],
+            }
+            if payload != last:
+                last = payload
+                yield {"event": "progress", "data": orjson.dumps(payload).decode()}
 
             if job["done"]:
                 yield {"event": "done", "data": "ok"}
                 break
 
-            await asyncio.sleep(0.3)
+            # Sem polling: só acorda em transição real de progresso/status.
+            # Keep-alive (alguns proxies derrubam SSE em streams "silenciosos")
+            try:
+                await asyncio.wait_for(changed.wait(), timeout=15)
+            except asyncio.TimeoutError:
+                yield {"event": "ping", "data": "keepalive"}
 
     return EventSourceResponse(event_generator())
 
@@ -219,7 +339,7 @@ async def download(job_id: str):
     job = JOBS.get(job_id)
     if not job:
         raise HTTPException(404, "job não encontrado")
-    if not job["done"] or not job["file_bytes"]:
+    if not job["done"] or not job["file_path"]:
         raise HTTPException(409, "Arquivo ainda não está pronto")
 
     filename = job["file_name"]
@@ -229,8 +349,7 @@ async def download(job_id: str):
         else "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
     )
 
-    return StreamingResponse(
-        iter([job["file_bytes"]]),
-        media_type=media_type,
-        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
-    )
\ No newline at end of file
+    if not os.path.exists(job["file_path"]):
+        raise HTTPException(410, "Arquivo expirou, processe o lote novamente")
+
+    return FileResponse(job["file_path"], media_type=media_type, filename=filename)
\ No newline at end of file
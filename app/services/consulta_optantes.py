@@ -1,16 +1,32 @@
-import time
+import asyncio
 import pandas as pd
+from collections import Counter
 from datetime import datetime
 from typing import Callable, Optional
 
-from app.services.consulta_site import consultar_optante, selenium_close
+from aiolimiter import AsyncLimiter
 
+from app.services.consulta_site import (
+    PUBLIC_API_MIN_DELAY,
+    _cache_get_many,
+    _cache_set_many,
+    close_client,
+    consultar_optante,
+    get_client,
+    get_limiter,
+    selenium_close,
+)
 
-# API pública do CNPJá: 5 consultas/minuto por IP => ~12s por consulta.
-PUBLIC_API_MIN_DELAY = 12.5
+# Grava o cache em lotes: poucas transações, mas sem perder muito "resume" se o processo cair
+CACHE_FLUSH_EVERY = 25
 
 
-def consultar_optante_lote(
+def _public(r: dict) -> dict:
+    """Remove os campos internos (``_cached``, ``_etag``...) antes de ir para o arquivo."""
+    return {k: v for k, v in r.items() if not k.startswith("_")}
+
+
+async def consultar_optante_lote_async(
     df_validos: pd.DataFrame,
     sleep_seconds: float = PUBLIC_API_MIN_DELAY,
     progress_cb: Optional[Callable[[int, int], None]] = None,
@@ -35,6 +51,14 @@ def consultar_optante_lote(
         sleep_seconds = PUBLIC_API_MIN_DELAY
     sleep_seconds = max(PUBLIC_API_MIN_DELAY, sleep_seconds)
 
+    # Rate limit do CNPJá (por IP): balde compartilhado com os outros lotes do processo.
+    # Em vez de "espera e depois envia", dispara assim que houver token disponível.
+    limiter = get_limiter()
+
+    # Delay maior que o mínimo pedido pelo usuário: ritmo próprio do lote, sem rajada
+    # (1 consulta a cada sleep_seconds), além do limite compartilhado.
+    pace = AsyncLimiter(1, sleep_seconds) if sleep_seconds > PUBLIC_API_MIN_DELAY else None
+
     def _tick():
         if progress_cb:
             try:
@@ -44,20 +68,44 @@ def consultar_optante_lote(
 
     _tick()
 
+    # CNPJ repetido é consultado uma vez só; o resultado é replicado para todas as linhas
+    occurrences = Counter(cnpjs)
+
+    # Prefetch do cache em uma única consulta: hits saem na hora, só os misses vão para a API
+    # (vencidos com ETag vão como "stale" para revalidar com If-None-Match)
+    # (sqlite bloqueante: fora do event loop para não travar SSE/requests)
+    cached = await asyncio.to_thread(_cache_get_many, list(occurrences), include_stale=True)
+    result_map = {c: _public(r) for c, r in cached.items() if r["_cached"]}
+    misses = [c for c in occurrences if c not in result_map]
+
+    done += len(cnpjs) - sum(occurrences[c] for c in misses)
+    _tick()
+
+    to_cache = []
+    client = get_client()
     try:
-        for cnpj in cnpjs:
+        for cnpj in misses:
             if should_cancel and should_cancel():
                 break
 
-            r = consultar_optante(cnpj)
-            # Se veio do cache, não precisamos esperar (economiza MUITO em reprocessamentos)
-            cached = bool(r.pop("_cached", False))
-            resultados.append(r)
+            if pace is not None:
+                await pace.acquire()
+
+            r = await consultar_optante(
+                cnpj, client=client, limiter=limiter, use_cache=False, stale=cached.get(cnpj)
+            )
+            result_map[cnpj] = _public(r)
+            if not r.get("erro"):
+                to_cache.append(r)
+                if len(to_cache) >= CACHE_FLUSH_EVERY:
+                    await asyncio.to_thread(_cache_set_many, to_cache)
+                    to_cache = []
 
-            done += 1
+            done += occurrences[cnpj]
             _tick()
-            if not cached:
-                time.sleep(max(0.0, float(sleep_seconds)))
+
+        # mantém a ordem original do arquivo
+        resultados = [result_map[c] for c in cnpjs if c in result_map]
 
         # Se cancelou, encerra sem adicionar inválidos (para parar o lote de verdade)
         if should_cancel and should_cancel():
@@ -76,6 +124,7 @@ def consultar_optante_lote(
                 _tick()
 
     finally:
+        await asyncio.to_thread(_cache_set_many, to_cache)
         # compat - hoje é no-op
         selenium_close()
 
@@ -85,3 +134,26 @@ def consultar_optante_lote(
         )
 
     return pd.DataFrame(resultados)
+
+
+def consultar_optante_lote(
+    df_validos: pd.DataFrame,
+    sleep_seconds: float = PUBLIC_API_MIN_DELAY,
+    progress_cb: Optional[Callable[[int, int], None]] = None,
+    should_cancel: Optional[Callable[[], bool]] = None,
+) -> pd.DataFrame:
+    """Versão síncrona (compat) de ``consultar_optante_lote_async``."""
+
+    async def _run():
+        try:
+            return await consultar_optante_lote_async(
+                df_validos,
+                sleep_seconds=sleep_seconds,
+                progress_cb=progress_cb,
+                should_cancel=should_cancel,
+            )
+        finally:
+            # o loop do asyncio.run morre aqui; não deixa o client pendurado nele
+            await close_client()
+
+    return asyncio.run(_run())
@@ -1,11 +1,15 @@
 import re
 import time
-import requests
+import asyncio
+import httpx
+import orjson
 import os
 import sqlite3
 import threading
 from datetime import datetime
-from typing import Any, Dict, Optional
+from typing import Any, Dict, List, Optional
+
+from aiolimiter import AsyncLimiter
 
 # =========================
 # CNPJá - API pública (sem scraping)
@@ -18,6 +22,19 @@ OPEN_CNPJA_BASE = "https://open.cnpja.com/office"
 
 DEFAULT_TIMEOUT = 25
 
+# API pública do CNPJá: 5 consultas/minuto por IP => ~12s por consulta.
+PUBLIC_API_MIN_DELAY = 12.5
+PUBLIC_API_MAX_PER_MINUTE = 5
+
+# Conexões simultâneas com o CNPJá (o limite real é o rate limiter compartilhado)
+MAX_CONNECTIONS = 5
+
+# As consultas saem a cada ~12s: mantém a conexão viva entre elas (padrão do httpx é 5s)
+KEEPALIVE_EXPIRY = 90
+
+_CNPJ_DIGITS = re.compile(r"\D+")
+_CNPJ_14 = re.compile(r"\d{14}")
+
 # =========================
 # Cache local (SQLite)
 # =========================
@@ -31,6 +48,26 @@ DEFAULT_CACHE_TTL_SECONDS = int(os.getenv("CNPJA_CACHE_TTL_SECONDS", str(24 * 60
 
 _cache_lock = threading.Lock()
 
+# Conexões persistentes (uma por arquivo de cache), reaproveitadas entre consultas
+_connections: Dict[str, sqlite3.Connection] = {}
+
+# SQLite aceita no máximo 999 parâmetros por statement (versões antigas)
+_SQLITE_MAX_PARAMS = 900
+
+_CACHE_COLUMNS = "cnpj, razao_social, simples_nacional, simei, data_consulta, fetched_at, etag"
+
+_CACHE_UPSERT = """
+    INSERT INTO cnpja_cache (cnpj, razao_social, simples_nacional, simei, data_consulta, fetched_at, etag)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(cnpj) DO UPDATE SET
+        razao_social=excluded.razao_social,
+        simples_nacional=excluded.simples_nacional,
+        simei=excluded.simei,
+        data_consulta=excluded.data_consulta,
+        fetched_at=excluded.fetched_at,
+        etag=excluded.etag
+"""
+
 
 def _ensure_cache_dir(path: str) -> None:
     d = os.path.dirname(path)
@@ -39,8 +76,16 @@ def _ensure_cache_dir(path: str) -> None:
 
 
 def _db_connect(path: str) -> sqlite3.Connection:
-    _ensure_cache_dir(path)
-    conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    # autocommit: leituras não abrem transação; escritas usam BEGIN/COMMIT explícitos
+    conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+
+def _init_db(conn: sqlite3.Connection) -> None:
+    """Cria/migra o schema do cache (uma vez por conexão persistente)."""
     conn.execute(
         """
         CREATE TABLE IF NOT EXISTS cnpja_cache (
@@ -49,31 +94,49 @@ def _db_connect(path: str) -> sqlite3.Connection:
             simples_nacional TEXT,
             simei TEXT,
             data_consulta TEXT,
-            fetched_at INTEGER
+            fetched_at INTEGER,
+            etag TEXT
         )
         """
     )
-    conn.commit()
+    # migração: caches criados antes da coluna etag
+    columns = {r[1] for r in conn.execute("PRAGMA table_info(cnpja_cache)")}
+    if "etag" not in columns:
+        conn.execute("ALTER TABLE cnpja_cache ADD COLUMN etag TEXT")
+
+
+def _get_conn(path: str) -> sqlite3.Connection:
+    """Devolve a conexão persistente do cache (chamar com ``_cache_lock``)."""
+    conn = _connections.get(path)
+    if conn is None:
+        _ensure_cache_dir(path)
+        conn = _db_connect(path)
+        _init_db(conn)
+        _connections[path] = conn
     return conn
 
 
-def _cache_get(cnpj: str, *, cache_path: str, ttl_seconds: int) -> Optional[Dict[str, Any]]:
-    now_ts = int(time.time())
+# Abre a conexão e prepara o schema já no import (e não a cada consulta).
+# Se falhar aqui (permissão, disco...), tenta de novo na primeira consulta.
+try:
     with _cache_lock:
-        conn = _db_connect(cache_path)
-        try:
-            row = conn.execute(
-                "SELECT cnpj, razao_social, simples_nacional, simei, data_consulta, fetched_at FROM cnpja_cache WHERE cnpj = ?",
-                (cnpj,),
-            ).fetchone()
-        finally:
-            conn.close()
+        _get_conn(DEFAULT_CACHE_PATH)
+except (OSError, sqlite3.Error):
+    pass
 
-    if not row:
-        return None
 
+def _row_to_payload(
+    row, *, now_ts: int, ttl_seconds: int, include_stale: bool = False
+) -> Optional[Dict[str, Any]]:
+    """Converte a linha do cache.
+
+    Entrada vencida (TTL) volta como None, ou - com ``include_stale`` e se tiver ETag -
+    com ``_cached=False`` e ``_etag``, para revalidar com ``If-None-Match``.
+    """
     fetched_at = int(row[5] or 0)
-    if ttl_seconds > 0 and fetched_at > 0 and (now_ts - fetched_at) > ttl_seconds:
+    etag = row[6] or ""
+    expired = ttl_seconds > 0 and fetched_at > 0 and (now_ts - fetched_at) > ttl_seconds
+    if expired and not (include_stale and etag):
         return None
 
     return {
@@ -83,45 +146,121 @@ def _cache_get(cnpj: str, *, cache_path: str, ttl_seconds: int) -> Optional[Dict
         "simei": row[3] or "",
         "data_consulta": row[4] or "",
         "erro": "",
-        "_cached": True,
+        "_cached": not expired,
+        "_etag": etag,
     }
 
 
-def _cache_set(payload: Dict[str, Any], *, cache_path: str) -> None:
+def _cache_get(
+    cnpj: str, *, cache_path: str, ttl_seconds: int, include_stale: bool = False
+) -> Optional[Dict[str, Any]]:
+    now_ts = int(time.time())
+    with _cache_lock:
+        row = _get_conn(cache_path).execute(
+            f"SELECT {_CACHE_COLUMNS} FROM cnpja_cache WHERE cnpj = ?",
+            (cnpj,),
+        ).fetchone()
+
+    if not row:
+        return None
+
+    return _row_to_payload(row, now_ts=now_ts, ttl_seconds=ttl_seconds, include_stale=include_stale)
+
+
+def _cache_get_many(
+    cnpjs: List[str],
+    *,
+    cache_path: str = DEFAULT_CACHE_PATH,
+    ttl_seconds: int = DEFAULT_CACHE_TTL_SECONDS,
+    include_stale: bool = False,
+) -> Dict[str, Dict[str, Any]]:
+    """Busca vários CNPJs no cache com ``WHERE cnpj IN (...)`` (em blocos de até 900)."""
+    now_ts = int(time.time())
+    keys = list(dict.fromkeys(c for c in cnpjs if c))
+    rows = []
+    with _cache_lock:
+        conn = _get_conn(cache_path)
+        for i in range(0, len(keys), _SQLITE_MAX_PARAMS):
+            chunk = keys[i:i + _SQLITE_MAX_PARAMS]
+            placeholders = ",".join("?" * len(chunk))
+            rows.extend(
+                conn.execute(
+                    f"SELECT {_CACHE_COLUMNS} FROM cnpja_cache WHERE cnpj IN ({placeholders})",
+                    chunk,
+                ).fetchall()
+            )
+
+    out: Dict[str, Dict[str, Any]] = {}
+    for row in rows:
+        payload = _row_to_payload(row, now_ts=now_ts, ttl_seconds=ttl_seconds, include_stale=include_stale)
+        if payload:
+            out[payload["cnpj"]] = payload
+    return out
+
+
+def _cache_row(payload: Dict[str, Any], fetched_at: int) -> Optional[tuple]:
     cnpj = str(payload.get("cnpj") or "")
-    if not re.fullmatch(r"\d{14}", cnpj):
+    if not _CNPJ_14.fullmatch(cnpj):
+        return None
+    return (
+        cnpj,
+        str(payload.get("razao_social") or ""),
+        str(payload.get("simples_nacional") or ""),
+        str(payload.get("simei") or ""),
+        str(payload.get("data_consulta") or ""),
+        fetched_at,
+        str(payload.get("_etag") or "") or None,
+    )
+
+
+def _cache_set(payload: Dict[str, Any], *, cache_path: str) -> None:
+    _cache_set_many([payload], cache_path=cache_path)
+
+
+def _cache_set_many(payloads: List[Dict[str, Any]], *, cache_path: str = DEFAULT_CACHE_PATH) -> None:
+    """Grava vários resultados de uma vez (``executemany`` + um único commit)."""
+    now_ts = int(time.time())
+    rows = [r for r in (_cache_row(p, now_ts) for p in payloads) if r]
+    if not rows:
         return
 
     with _cache_lock:
-        conn = _db_connect(cache_path)
+        conn = _get_conn(cache_path)
+        # uma transação só (commit único / rollback se falhar no meio)
+        conn.execute("BEGIN")
         try:
-            conn.execute(
-                """
-                INSERT INTO cnpja_cache (cnpj, razao_social, simples_nacional, simei, data_consulta, fetched_at)
-                VALUES (?, ?, ?, ?, ?, ?)
-                ON CONFLICT(cnpj) DO UPDATE SET
-                    razao_social=excluded.razao_social,
-                    simples_nacional=excluded.simples_nacional,
-                    simei=excluded.simei,
-                    data_consulta=excluded.data_consulta,
-                    fetched_at=excluded.fetched_at
-                """,
-                (
-                    cnpj,
-                    str(payload.get("razao_social") or ""),
-                    str(payload.get("simples_nacional") or ""),
-                    str(payload.get("simei") or ""),
-                    str(payload.get("data_consulta") or ""),
-                    int(time.time()),
-                ),
-            )
-            conn.commit()
-        finally:
-            conn.close()
+            conn.executemany(_CACHE_UPSERT, rows)
+            conn.execute("COMMIT")
+        except Exception:
+            # inclui falha no próprio COMMIT (SQLITE_BUSY, disco cheio): a conexão é
+            # persistente, então não pode ficar presa numa transação aberta
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
 
 
 def _clean_cnpj(cnpj: str) -> str:
-    return re.sub(r"\D+", "", str(cnpj or ""))
+    return _CNPJ_DIGITS.sub("", str(cnpj or ""))
+
+
+_SIM = frozenset({"sim", "s", "yes", "true", "1", "optante"})
+_NAO = frozenset({"nao", "não", "n", "no", "false", "0", "nao optante", "não optante"})
+
+# chaves mais comuns do indicador de opção (em ordem de prioridade)
+_OPTANT_KEYS = (
+    "optant",
+    "opted",
+    "is_optant",
+    "isOptant",
+    "is_opted",
+    "option",
+    "enabled",
+    "mei",  # às vezes SIMEI vem assim
+    "active",
+    "status",
+)
+
+_MISS = object()
 
 
 def _as_sim_nao(value: Any) -> str:
@@ -134,9 +273,9 @@ def _as_sim_nao(value: Any) -> str:
         return "Sim" if int(value) == 1 else "Não"
     if isinstance(value, str):
         s = value.strip().lower()
-        if s in {"sim", "s", "yes", "true", "1", "optante"}:
+        if s in _SIM:
             return "Sim"
-        if s in {"nao", "não", "n", "no", "false", "0", "nao optante", "não optante"}:
+        if s in _NAO:
             return "Não"
         # alguns retornos podem trazer status textual
         if "optante" in s and "nao" not in s and "não" not in s:
@@ -153,31 +292,20 @@ def _extract_optant_flag(obj: Any) -> str:
     if isinstance(obj, (bool, int, float, str)):
         return _as_sim_nao(obj)
     if isinstance(obj, dict):
-        # chaves mais comuns
-        for k in [
-            "optant",
-            "opted",
-            "is_optant",
-            "isOptant",
-            "is_opted",
-            "option",
-            "enabled",
-            "mei",  # às vezes SIMEI vem assim
-            "active",
-            "status",
-        ]:
-            if k in obj:
-                v = obj.get(k)
-                # status pode ser "OPTANT"/"NON_OPTANT"
-                if k == "status" and isinstance(v, str):
-                    sv = v.strip().lower()
-                    if "opt" in sv and "non" not in sv and "nao" not in sv and "não" not in sv:
-                        return "Sim"
-                    if "non" in sv or "nao" in sv or "não" in sv:
-                        return "Não"
-                out = _as_sim_nao(v)
-                if out:
-                    return out
+        for k in _OPTANT_KEYS:
+            v = obj.get(k, _MISS)
+            if v is _MISS:
+                continue
+            # status pode ser "OPTANT"/"NON_OPTANT"
+            if k == "status" and isinstance(v, str):
+                sv = v.strip().lower()
+                if "opt" in sv and "non" not in sv and "nao" not in sv and "não" not in sv:
+                    return "Sim"
+                if "non" in sv or "nao" in sv or "não" in sv:
+                    return "Não"
+            out = _as_sim_nao(v)
+            if out:
+                return out
 
         # fallback: procura qualquer boolean no dict
         for v in obj.values():
@@ -188,7 +316,9 @@ def _extract_optant_flag(obj: Any) -> str:
 
 
 def _pick_razao_social(data: Dict[str, Any]) -> str:
-    company = (data or {}).get("company") or {}
+    company = (data or {}).get("company")
+    if not isinstance(company, dict):
+        return ""
     # tenta várias chaves possíveis
     for k in [
         "name",
@@ -211,25 +341,89 @@ def _pick_razao_social(data: Dict[str, Any]) -> str:
     return ""
 
 
-def consultar_optante(
+def new_client(timeout: int = DEFAULT_TIMEOUT) -> httpx.AsyncClient:
+    """Cria o client HTTP (HTTP/2, pool limitado) usado nas consultas ao CNPJá."""
+    return httpx.AsyncClient(
+        http2=True,
+        timeout=timeout,
+        limits=httpx.Limits(
+            max_connections=MAX_CONNECTIONS,
+            max_keepalive_connections=MAX_CONNECTIONS,
+            keepalive_expiry=KEEPALIVE_EXPIRY,
+        ),
+        headers={
+            "User-Agent": "consulta-optantes/1.0 (+https://cnpja.com/api/open)",
+            "Accept": "application/json",
+        },
+    )
+
+
+# Client compartilhado (keep-alive): evita handshake TCP+TLS a cada consulta.
+# Fica atrelado ao event loop em que foi criado.
+_client: Optional[httpx.AsyncClient] = None
+_client_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def get_client() -> httpx.AsyncClient:
+    """Devolve o client persistente do event loop atual (cria se necessário)."""
+    global _client, _client_loop
+    loop = asyncio.get_running_loop()
+    if _client is None or _client.is_closed or _client_loop is not loop:
+        _client = new_client()
+        _client_loop = loop
+    return _client
+
+
+# Rate limiter compartilhado (token bucket): o limite do CNPJá é por IP, então todos os
+# lotes e consultas avulsas do processo dividem o mesmo balde. Um por event loop.
+_limiter: Optional[AsyncLimiter] = None
+_limiter_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def get_limiter() -> AsyncLimiter:
+    """Devolve o rate limiter do event loop atual (5 consultas a cada 5 x 12.5s)."""
+    global _limiter, _limiter_loop
+    loop = asyncio.get_running_loop()
+    if _limiter is None or _limiter_loop is not loop:
+        _limiter = AsyncLimiter(PUBLIC_API_MAX_PER_MINUTE, PUBLIC_API_MAX_PER_MINUTE * PUBLIC_API_MIN_DELAY)
+        _limiter_loop = loop
+    return _limiter
+
+
+async def close_client() -> None:
+    global _client, _client_loop
+    if _client is not None and not _client.is_closed:
+        await _client.aclose()
+    _client = None
+    _client_loop = None
+
+
+async def consultar_optante(
     cnpj: str,
     *,
+    client: Optional[httpx.AsyncClient] = None,
+    limiter: Optional[AsyncLimiter] = None,
     timeout: int = DEFAULT_TIMEOUT,
     use_cache: bool = True,
     cache_path: str = DEFAULT_CACHE_PATH,
     cache_ttl_seconds: int = DEFAULT_CACHE_TTL_SECONDS,
     max_retries: int = 3,
+    stale: Optional[Dict[str, Any]] = None,
 ) -> Dict[str, Any]:
     """Consulta CNPJ no CNPJá (API pública) e devolve o formato do app.
 
     Melhorias:
     - Cache SQLite (acelera reprocessamentos e permite "resume")
     - Retry inteligente (429/5xx/erros de rede) sem flood
+    - Rate limit via ``limiter`` (padrão: o compartilhado de ``get_limiter``): só consultas
+      reais consomem token, cache hit retorna na hora
+    - Entrada vencida do cache (``stale``) é revalidada com ``If-None-Match``: em 304
+      reaproveita o payload sem baixar/parsear o JSON
     """
     cnpj_clean = _clean_cnpj(cnpj)
     now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-    if not re.fullmatch(r"\d{14}", cnpj_clean or ""):
+    if not _CNPJ_14.fullmatch(cnpj_clean or ""):
         return {
             "cnpj": cnpj_clean,
             "razao_social": "",
@@ -240,23 +434,42 @@ def consultar_optante(
             "_cached": False,
         }
 
-    if use_cache:
-        cached = _cache_get(cnpj_clean, cache_path=cache_path, ttl_seconds=int(cache_ttl_seconds))
-        if cached:
+    if use_cache and stale is None:
+        cached = await asyncio.to_thread(
+            _cache_get,
+            cnpj_clean,
+            cache_path=cache_path,
+            ttl_seconds=int(cache_ttl_seconds),
+            include_stale=True,
+        )
+        if cached and cached["_cached"]:
             return cached
+        stale = cached
+
+    if client is None:
+        client = get_client()
+    if limiter is None:
+        limiter = get_limiter()
 
     url = f"{OPEN_CNPJA_BASE}/{cnpj_clean}"
 
-    headers = {
-        "User-Agent": "consulta-optantes/1.0 (+https://cnpja.com/api/open)",
-        "Accept": "application/json",
-    }
+    headers = {}
+    if stale and stale.get("_etag"):
+        headers["If-None-Match"] = stale["_etag"]
 
     last_err = ""
     attempts = max(1, int(max_retries))
     for attempt in range(1, attempts + 1):
         try:
-            r = requests.get(url, timeout=timeout, headers=headers)
+            async with limiter:
+                r = await client.get(url, timeout=timeout, headers=headers)
+
+            # Não mudou desde a última consulta: renova o cache com o payload que já temos
+            if r.status_code == 304 and stale:
+                payload = {**stale, "data_consulta": now, "_cached": True}
+                if use_cache:
+                    await asyncio.to_thread(_cache_set, payload, cache_path=cache_path)
+                return payload
 
             # Rate limit
             if r.status_code == 429:
@@ -274,7 +487,7 @@ def consultar_optante(
                 )
 
                 if attempt < attempts:
-                    time.sleep(max(1, min(90, wait_s)))
+                    await asyncio.sleep(max(1, min(90, wait_s)))
                     continue
 
                 return {
@@ -291,7 +504,7 @@ def consultar_optante(
             if r.status_code >= 500:
                 last_err = f"Erro HTTP {r.status_code} (servidor) ao consultar CNPJá"
                 if attempt < attempts:
-                    time.sleep(min(20, 2**attempt))
+                    await asyncio.sleep(min(20, 2**attempt))
                     continue
                 return {
                     "cnpj": cnpj_clean,
@@ -315,8 +528,12 @@ def consultar_optante(
                     "_cached": False,
                 }
 
-            data = r.json() or {}
-            company = data.get("company") or {}
+            data = (orjson.loads(r.content) if r.content else None) or {}
+            if not isinstance(data, dict):
+                raise ValueError(f"resposta inesperada do CNPJá ({type(data).__name__})")
+            company = data.get("company")
+            if not isinstance(company, dict):
+                company = {}
 
             simples_obj = company.get("simples") or company.get("simples_nacional") or data.get("simples")
             simei_obj = company.get("simei") or company.get("mei") or data.get("simei") or data.get("mei")
@@ -329,17 +546,34 @@ def consultar_optante(
                 "data_consulta": now,
                 "erro": "",
                 "_cached": False,
+                "_etag": r.headers.get("ETag") or "",
             }
 
             if use_cache:
-                _cache_set(payload, cache_path=cache_path)
+                await asyncio.to_thread(_cache_set, payload, cache_path=cache_path)
 
             return payload
 
-        except requests.RequestException as e:
+        except ValueError as e:
+            # corpo não-JSON (ex.: página HTML de desafio) ou JSON fora do formato
+            last_err = f"Resposta inválida do CNPJá: {type(e).__name__}: {e}"
+            if attempt < attempts:
+                await asyncio.sleep(min(15, 2**attempt))
+                continue
+            return {
+                "cnpj": cnpj_clean,
+                "razao_social": "",
+                "simples_nacional": "",
+                "simei": "",
+                "data_consulta": now,
+                "erro": last_err,
+                "_cached": False,
+            }
+
+        except httpx.HTTPError as e:
             last_err = f"Erro de rede: {type(e).__name__}: {e}"
             if attempt < attempts:
-                time.sleep(min(15, 2**attempt))
+                await asyncio.sleep(min(15, 2**attempt))
                 continue
             return {
                 "cnpj": cnpj_clean,
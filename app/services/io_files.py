@@ -7,6 +7,11 @@ CNPJ_COL_CANDIDATES = {
     "cnpj", "cnpj_matriz", "documento", "doc", "cpf_cnpj", "cnpj/cpf", "inscricao"
 }
 
+# Regex pré-compiladas (usadas por linha em planilhas grandes)
+_CNPJ_DIGITS = re.compile(r"\D+")
+_CNPJ_14 = re.compile(r"\d{14}")
+_CNPJ_FMT = re.compile(r"\b\d{2}\.?\d{3}\.?\d{3}/?\d{4}-?\d{2}\b")
+
 
 def _normalize_columns(df: pd.DataFrame) -> pd.DataFrame:
     df = df.copy()
@@ -36,46 +41,65 @@ def _guess_cnpj_column_by_content(df: pd.DataFrame) -> str | None:
     best_score = 0
     for c in df.columns:
         try:
-            s = df[c].apply(_clean_cnpj)
+            s = _clean_cnpj_series(df[c])
         except Exception:
             continue
-        score = int(s.apply(_is_valid_14).sum())
+        score = int(_is_valid_14_series(s).sum())
         if score > best_score:
             best_score = score
             best_col = c
     return best_col if best_score > 0 else None
 
 
-def _extract_first_cnpj_from_row(row: pd.Series) -> str:
-    """Extrai o primeiro CNPJ (14 dígitos) encontrado em qualquer célula da linha."""
-    try:
-        text = " ".join(["" if v is None else str(v) for v in row.values])
-    except Exception:
-        text = str(row)
+def _extract_first_cnpj(df: pd.DataFrame) -> pd.Series:
+    """Extrai o primeiro CNPJ (14 dígitos) encontrado em qualquer célula de cada linha.
+
+    Vetorizado: junta as células da linha e aplica as regex em todas as linhas de uma vez.
+    """
+    if df.empty:
+        return pd.Series("", index=df.index, dtype=object)
+
+    text = df.fillna("").astype(str).agg(" ".join, axis=1)
 
     # pega sequências de 14 dígitos (com ou sem pontuação)
-    digits = re.sub(r"\D+", " ", text)
-    for token in digits.split():
-        if _is_valid_14(token):
-            return token
+    tokens = text.str.replace(_CNPJ_DIGITS.pattern, " ", regex=True)
+    first = tokens.str.extract(r"(?<!\d)(\d{14})(?!\d)", expand=False)
 
     # fallback: procura padrão com pontuação típica
-    m = re.search(r"\b\d{2}\.?\d{3}\.?\d{3}/?\d{4}-?\d{2}\b", text)
-    if m:
-        cnpj = _clean_cnpj(m.group(0))
-        return cnpj
+    fmt = _clean_cnpj_series(text.str.extract(f"({_CNPJ_FMT.pattern})", expand=False))
+    fmt = fmt.where(fmt != "")
 
-    return ""
+    return first.fillna(fmt).fillna("")
 
 
 def _clean_cnpj(value) -> str:
-    if value is None:
-        return ""
-    return re.sub(r"\D+", "", str(value))
+    return "" if value is None else _CNPJ_DIGITS.sub("", str(value))
 
 
 def _is_valid_14(cnpj: str) -> bool:
-    return bool(re.fullmatch(r"\d{14}", cnpj or ""))
+    return bool(_CNPJ_14.fullmatch(cnpj or ""))
+
+
+def _clean_cnpj_series(s: pd.Series) -> pd.Series:
+    """Versão vetorizada de ``_clean_cnpj`` (roda em C, sem callback por linha)."""
+    return s.fillna("").astype(str).str.replace(_CNPJ_DIGITS.pattern, "", regex=True)
+
+
+def _is_valid_14_series(s: pd.Series) -> pd.Series:
+    """Versão vetorizada de ``_is_valid_14``."""
+    return s.str.fullmatch(_CNPJ_14.pattern).fillna(False).astype(bool)
+
+
+def _read_excel_calamine(content: bytes) -> pd.DataFrame | None:
+    """Lê XLSX/XLS com o engine calamine (Rust, pandas >= 2.2).
+
+    Devolve None se não conseguir ler por qualquer motivo (sem python-calamine, pandas
+    antigo, ou arquivo que o calamine não entende) - o chamador tenta outro engine.
+    """
+    try:
+        return pd.read_excel(io.BytesIO(content), engine="calamine", dtype=str)
+    except Exception:
+        return None
 
 
 def read_input_file_to_df(file: UploadFile) -> pd.DataFrame:
@@ -98,12 +122,18 @@ def read_input_file_to_df(file: UploadFile) -> pd.DataFrame:
     # Leitura XLSX
     # -------------------------
     elif name.endswith(".xlsx"):
-        df = pd.read_excel(io.BytesIO(content), engine="openpyxl", dtype=str)
+        # se o calamine não conseguir ler, tenta com openpyxl
+        df = _read_excel_calamine(content)
+        if df is None:
+            df = pd.read_excel(io.BytesIO(content), engine="openpyxl", dtype=str)
 
     # -------------------------
     # Leitura XLS (antigo)
     # -------------------------
     elif name.endswith(".xls"):
+        # calamine também lê .xls; se não der, cai nas tentativas com xlrd
+        df = _read_excel_calamine(content)
+
         def _try_read_xls(header: int | None = 0, sheet_name=0) -> pd.DataFrame:
             return pd.read_excel(
                 io.BytesIO(content),
@@ -114,21 +144,22 @@ def read_input_file_to_df(file: UploadFile) -> pd.DataFrame:
             )
 
         # Estratégia: tenta algumas combinações comuns antes de desistir
-        last_exc = None
-        for sheet in (0, 1, None):
-            for header in (0, 1, None):
-                try:
-                    df = _try_read_xls(header=header, sheet_name=sheet)
-                    # Se veio vazio demais, tenta próximo
-                    if df is None or df.shape[1] == 0:
-                        continue
-                    # Achou algo plausível
+        if df is None or df.shape[1] == 0:
+            last_exc = None
+            for sheet in (0, 1, None):
+                for header in (0, 1, None):
+                    try:
+                        df = _try_read_xls(header=header, sheet_name=sheet)
+                        # Se veio vazio demais, tenta próximo
+                        if df is None or df.shape[1] == 0:
+                            continue
+                        # Achou algo plausível
+                        break
+                    except Exception as e:
+                        last_exc = e
+                        df = None
+                if df is not None and df.shape[1] > 0:
                     break
-                except Exception as e:
-                    last_exc = e
-                    df = None
-            if df is not None and df.shape[1] > 0:
-                break
 
         if df is None or df.shape[1] == 0:
             # Mensagem clara (e prática)
@@ -165,16 +196,16 @@ def read_input_file_to_df(file: UploadFile) -> pd.DataFrame:
     if col is None:
         col = _guess_cnpj_column_by_content(df)
 
-    # 3) se ainda não achou, faz varredura linha-a-linha (CNPJ pode estar em qualquer coluna)
+    # 3) se ainda não achou, varre todas as células (CNPJ pode estar em qualquer coluna)
     if col is None:
-        df["cnpj_input"] = df.apply(lambda r: _extract_first_cnpj_from_row(r), axis=1)
-        df["cnpj"] = df["cnpj_input"].apply(_clean_cnpj)
-        df["cnpj_valido"] = df["cnpj"].apply(_is_valid_14)
+        df["cnpj_input"] = _extract_first_cnpj(df)
+        df["cnpj"] = _clean_cnpj_series(df["cnpj_input"])
+        df["cnpj_valido"] = _is_valid_14_series(df["cnpj"])
     else:
         # cria SEMPRE as colunas padrão no DF inteiro
         df["cnpj_input"] = df[col]
-        df["cnpj"] = df[col].apply(_clean_cnpj)
-        df["cnpj_valido"] = df["cnpj"].apply(_is_valid_14)
+        df["cnpj"] = _clean_cnpj_series(df[col])
+        df["cnpj_valido"] = _is_valid_14_series(df["cnpj"])
 
     # separa válidos/ inválidos
     df_validos = df[df["cnpj_valido"]].drop_duplicates(subset=["cnpj"]).copy()
@@ -210,7 +241,13 @@ def build_output_bytes(df_out: pd.DataFrame, output: str) -> bytes:
 
     if output == "xlsx":
         buffer = io.BytesIO()
-        with pd.ExcelWriter(buffer, engine="openpyxl") as writer:
+        # xlsxwriter é mais rápido/leve que openpyxl. Não usar constant_memory: o to_excel
+        # do pandas escreve coluna a coluna e esse modo descarta células de linhas já gravadas.
+        with pd.ExcelWriter(
+            buffer,
+            engine="xlsxwriter",
+            engine_kwargs={"options": {"strings_to_urls": False}},
+        ) as writer:
             df_out.to_excel(writer, index=False, sheet_name="resultado")
         return buffer.getvalue()
 
@@ -0,0 +1,27 @@
+import io
+
+import pandas as pd
+
+from app.services.io_files import build_output_bytes
+
+
+def test_build_output_bytes_xlsx_round_trip_keeps_all_columns():
+    df_out = pd.DataFrame(
+        [
+            {
+                "cnpj": f"0000000000000{i}",
+                "razao_social": f"Empresa {i}",
+                "simples_nacional": "Sim",
+                "simei": "Não",
+                "data_consulta": "2024-01-01 10:00:00",
+                "erro": "",
+            }
+            for i in range(3)
+        ]
+    )
+
+    content = build_output_bytes(df_out, "xlsx")
+    df_back = pd.read_excel(io.BytesIO(content), dtype=str, keep_default_na=False)
+
+    assert list(df_back.columns) == list(df_out.columns)
+    pd.testing.assert_frame_equal(df_back, df_out, check_dtype=False)